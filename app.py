@@ -6,6 +6,14 @@ import base64
 import threading
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
 
 app = Flask(__name__)
 
@@ -14,56 +22,162 @@ live_detector = None
 live_camera = None
 live_active = False
 live_lock = threading.Lock()
+live_broadcaster = None
+live_thread = None
+debug_view = False
 
 # Global variables for video detection
 video_detector = None
 current_video_path = None
 video_filename = None
 
+# JPEG settings for streamed frames - quality 75 is much cheaper to encode than the default 95
+JPEG_PARAMS = [int(cv2.IMWRITE_JPEG_QUALITY), 75, int(cv2.IMWRITE_JPEG_OPTIMIZE), 0]
+
+# Status history ring buffer
+HISTORY_SIZE = 4096
+STATUS_NAMES = ("CLOSED", "OPEN")
+STATUS_CODES = {name: code for code, name in enumerate(STATUS_NAMES)}
+
+# OpenCV T-API: run the ROI pipeline on an OpenCL device (e.g. integrated GPU).
+# Off by default - on the downsampled ROI the upload costs more than the CPU path saves
+USE_OPENCL = False
+
+if NUMBA_AVAILABLE:
+    # Kernels specialized for a fixed ROI size; only the last few sizes are kept
+    @lru_cache(maxsize=4)
+    def _get_diff_kernel(height, width):
+        """Build a kernel counting pixels where |ref - cur| > thr for one ROI size"""
+        @njit('int64(uint8[:, ::1], uint8[:, ::1], int64)', nogil=True, fastmath=True)
+        def kernel(ref, cur, thr):
+            s = 0
+            for i in range(height):
+                for j in range(width):
+                    if abs(np.int32(ref[i, j]) - np.int32(cur[i, j])) > thr:
+                        s += 1
+            return s
+        return kernel
+
+
 class SimpleDoorDetector:
     def __init__(self):
         """Simple, reliable door detector with fixed ROI"""
         self.door_roi = None
-        self.reference_closed = None
+        # (roi, reference, total_pixels, diff_kernel) - replaced as a whole so the
+        # live processing thread never sees a half-updated calibration
+        self._calibration = None
         self.door_status = "Unknown"
-        self.history = []
+        # Status history as a fixed-size ring buffer: epoch seconds + status code
+        self._hist_ts = np.empty(HISTORY_SIZE, dtype='i8')
+        self._hist_st = np.empty(HISTORY_SIZE, dtype='u1')
+        self._hist_n = 0
+        self._last_logged = None
         self.threshold_percentage = 5.0
+        self.scale = 0.25  # ROI is downsampled before blur/diff
+        self.full_run_interval = 30  # frames the pre-check may skip in a row
+        self._skipped = 0
+        self._prev_roi_small = None
+        self._last_pct = 0
+        self.use_opencl = USE_OPENCL and cv2.ocl.haveOpenCL() and cv2.ocl.useOpenCL()
         
     def set_door_frame(self, roi):
         """Set the fixed frame around the door"""
         self.door_roi = roi
+        self._prev_roi_small = None
+        
+    def _prepare_roi(self, frame, roi):
+        """Cut out the door ROI, downsample it and return it as blurred grayscale.
+        With OpenCL the result is a cv2.UMat that stays on the device."""
+        x, y, w, h = roi
+        area = frame[y:y+h, x:x+w]
+        # Explicit size so tiny ROIs still give at least 1x1 instead of an empty image
+        area_h, area_w = area.shape[:2]
+        size = (max(1, round(area_w * self.scale)), max(1, round(area_h * self.scale)))
+        if self.use_opencl:
+            area = cv2.UMat(np.ascontiguousarray(area))
+        small = cv2.resize(area, size, interpolation=cv2.INTER_AREA)
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        blurred = cv2.GaussianBlur(small, (5, 5), 0)
+        if self.use_opencl:
+            return blurred
+        # Compact C-contiguous layout keeps OpenCV/Numba on their vectorized paths
+        return np.ascontiguousarray(blurred)
         
     def calibrate_closed(self, frame):
         """Capture what door looks like when CLOSED"""
-        if self.door_roi is None:
+        roi = self.door_roi
+        if roi is None:
             return False
             
-        x, y, w, h = self.door_roi
-        door_area = frame[y:y+h, x:x+w]
-        self.reference_closed = cv2.cvtColor(door_area, cv2.COLOR_BGR2GRAY)
-        self.reference_closed = cv2.GaussianBlur(self.reference_closed, (15, 15), 0)
+        reference = self._prepare_roi(frame, roi)
+        diff_kernel = None
+        if self.use_opencl:
+            # Reference stays on the device; download once just to size it
+            total_pixels = reference.get().size
+        else:
+            total_pixels = reference.size
+            if NUMBA_AVAILABLE:
+                diff_kernel = _get_diff_kernel(*reference.shape)
+        self._prev_roi_small = None
+        self._calibration = (roi, reference, total_pixels, diff_kernel)
         return True
     
-    def detect_door_status(self, frame):
-        """Detect if door is open or closed by comparing to reference"""
-        if self.door_roi is None or self.reference_closed is None:
+    def detect_door_status(self, frame, build_vis=False):
+        """Detect if door is open or closed by comparing to reference.
+        Visualization images are only built when build_vis is True."""
+        calibration = self._calibration
+        if calibration is None or self.door_roi != calibration[0]:
             return "Not Calibrated", None, 0
+        roi, reference, total_pixels, diff_kernel = calibration
         
-        x, y, w, h = self.door_roi
+        x, y, w, h = roi
         current_door = frame[y:y+h, x:x+w]
-        current_gray = cv2.cvtColor(current_door, cv2.COLOR_BGR2GRAY)
-        current_gray = cv2.GaussianBlur(current_gray, (15, 15), 0)
         
-        diff = cv2.absdiff(self.reference_closed, current_gray)
-        _, thresh = cv2.threshold(diff, 30, 255, cv2.THRESH_BINARY)
-        changed_pixels = np.sum(thresh > 0)
-        total_pixels = thresh.size
-        change_percentage = (changed_pixels / total_pixels) * 100
+        # Skip the full pipeline when far fewer sampled pixels changed since the last
+        # processed frame than would flip the status (never in debug view, which needs
+        # a fresh heatmap every frame, and never for too many frames in a row)
+        roi_sample = current_door[::8, ::8]
+        if (not build_vis and self._prev_roi_small is not None
+                and self._prev_roi_small.shape == roi_sample.shape
+                and self._skipped < self.full_run_interval):
+            moved = (np.abs(roi_sample.astype(np.int16) - self._prev_roi_small) > 30).any(axis=2)
+            if moved.mean() * 100 < self.threshold_percentage / 4:
+                self._skipped += 1
+                status = "OPEN" if self._last_pct > self.threshold_percentage else "CLOSED"
+                return status, None, self._last_pct
+        self._prev_roi_small = roi_sample.astype(np.int16)
+        self._skipped = 0
+        
+        current_gray = self._prepare_roi(frame, roi)
+        
+        if not self.use_opencl and current_gray.shape != reference.shape:
+            # Frame size changed since calibration
+            return "Not Calibrated", None, 0
+        
+        if diff_kernel is not None and not build_vis:
+            changed_pixels = diff_kernel(reference, current_gray, 30)
+        else:
+            diff = cv2.absdiff(reference, current_gray)
+            _, thresh = cv2.threshold(diff, 30, 255, cv2.THRESH_BINARY)
+            changed_pixels = cv2.countNonZero(thresh)
+        change_percentage = changed_pixels * 100.0 / total_pixels
         
         if change_percentage > self.threshold_percentage:
             status = "OPEN"
         else:
             status = "CLOSED"
+        self.door_status = status
+        self._last_pct = change_percentage
+        
+        if not build_vis:
+            return status, None, change_percentage
+        
+        # Bring diff/thresh back to ROI size for visualization only
+        if self.use_opencl:
+            diff, thresh = diff.get(), thresh.get()
+        roi_size = (current_door.shape[1], current_door.shape[0])
+        diff = cv2.resize(diff, roi_size, interpolation=cv2.INTER_NEAREST)
+        thresh = cv2.resize(thresh, roi_size, interpolation=cv2.INTER_NEAREST)
         
         vis = current_door.copy()
         diff_colored = cv2.applyColorMap(diff, cv2.COLORMAP_JET)
@@ -76,56 +190,201 @@ class SimpleDoorDetector:
         
         return status, (vis, diff_colored, thresh), change_percentage
     
+    def draw_door_frame(self, frame, thickness=2, label=None, status_box=False):
+        """Draw the door frame (and optional label/status box) onto frame"""
+        if self.door_roi:
+            x, y, w, h = self.door_roi
+            cv2.rectangle(frame, (x, y), (x+w, y+h), (0, 255, 255), thickness)
+            if label:
+                cv2.putText(frame, label, (x, y-10),
+                           cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 255), 2)
+        if status_box:
+            cv2.rectangle(frame, (5, 5), (300, 60), (0, 0, 0), -1)
+    
     def log_status(self, status):
         """Log status changes"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        if len(self.history) == 0 or self.history[-1]['status'] != status:
-            self.history.append({'timestamp': timestamp, 'status': status})
+        # Called every frame - unchanged status returns before any other work
+        if status == self._last_logged:
+            return
+        slot = self._hist_n % HISTORY_SIZE
+        self._hist_ts[slot] = int(time.time())
+        self._hist_st[slot] = STATUS_CODES[status]
+        self._hist_n += 1
+        self._last_logged = status
+    
+    def get_history(self, limit=HISTORY_SIZE):
+        """Return the last `limit` status changes, oldest first"""
+        count = min(self._hist_n, HISTORY_SIZE, limit)
+        slots = np.arange(self._hist_n - count, self._hist_n) % HISTORY_SIZE
+        return [{'timestamp': datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S"),
+                 'status': STATUS_NAMES[st]}
+                for ts, st in zip(self._hist_ts[slots].tolist(), self._hist_st[slots].tolist())]
+
+
+class CameraReader:
+    def __init__(self, cap):
+        """Read frames on a background thread, keeping only the newest one"""
+        self.cap = cap
+        self.latest = None
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def _run(self):
+        """Capture loop - overwrites the latest frame, never queues"""
+        while not self._stop.is_set():
+            ret, frame = self.cap.read()
+            if not ret:
+                break
+            with self._cond:
+                self.latest = frame
+                self._seq += 1
+                self._cond.notify_all()
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+    
+    def read(self, timeout=1.0):
+        """Return a copy of the newest frame, same signature as VideoCapture.read()"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.latest is not None or self._stop.is_set(), timeout)
+            frame = self.latest
+            if frame is None:
+                return False, None
+            return True, frame.copy()
+    
+    def read_next(self, seq):
+        """Wait for a frame newer than seq and take ownership of it, so the caller
+        can draw on it in place; returns (seq, frame) or (seq, None) once stopped"""
+        with self._cond:
+            self._cond.wait_for(lambda: (self._seq != seq and self.latest is not None)
+                                or self._stop.is_set())
+            frame = self.latest
+            if self._seq == seq or frame is None:
+                return seq, None
+            self.latest = None
+            return self._seq, frame
+    
+    def release(self):
+        """Stop the capture thread and release the camera"""
+        self._stop.set()
+        self._thread.join(timeout=1.0)
+        self.cap.release()
+
+
+class FrameBroadcaster:
+    def __init__(self):
+        """Share the latest encoded JPEG with every connected viewer"""
+        self.latest = None
+        self.viewers = 0
+        self._seq = 0
+        self._closed = False
+        self._cond = threading.Condition()
+    
+    def publish(self, jpeg_bytes):
+        """Replace the latest frame and wake all viewers"""
+        with self._cond:
+            self.latest = jpeg_bytes
+            self._seq += 1
+            self._cond.notify_all()
+    
+    def wait_next(self, seq):
+        """Wait for a frame newer than seq; returns (seq, bytes) or (seq, None) when closed"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._seq != seq or self._closed)
+            if self._seq == seq:
+                return seq, None
+            return self._seq, self.latest
+    
+    def close(self):
+        """Wake all viewers so their streams end"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+def encode_jpeg(frame):
+    """Encode a frame for streaming"""
+    ret, buffer = cv2.imencode('.jpg', frame, JPEG_PARAMS)
+    return buffer.tobytes()
+
+
+def live_processing_loop(camera, detector, broadcaster):
+    """Detect, draw and encode each live frame once, no matter how many viewers.
+    Encoding runs on a worker thread, overlapping with detection of the next frame."""
+    encoder = ThreadPoolExecutor(max_workers=1)
+    pending = None
+    seq = 0
+    try:
+        while live_active:
+            seq, frame = camera.read_next(seq)
+            if frame is None:
+                break
+            
+            # Detect door status
+            status, processed, change_pct = detector.detect_door_status(frame, build_vis=debug_view)
+            
+            # Log status
+            if status in ["OPEN", "CLOSED"]:
+                detector.log_status(status)
+            
+            # Nobody watching, or the previous frame is still encoding - skip drawing and encoding
+            if broadcaster.viewers == 0 or (pending is not None and not pending.done()):
+                continue
+            
+            # frame is owned by this loop, so overlays are drawn on it directly
+            display_frame = frame
+            
+            # Show the diff heatmap inside the door frame in debug mode
+            if processed is not None:
+                x, y, w, h = detector.door_roi
+                region = display_frame[y:y+h, x:x+w]
+                # The door frame may have moved since detection ran
+                if region.shape == processed[1].shape:
+                    region[:] = processed[1]
+            
+            # Draw door frame and status box
+            detector.draw_door_frame(display_frame, thickness=2, label="DOOR FRAME", status_box=True)
+            
+            # Display status
+            status_color = (0, 255, 0) if status == "CLOSED" else (0, 0, 255)
+            cv2.putText(display_frame, f"Door: {status}", (10, 40),
+                       cv2.FONT_HERSHEY_SIMPLEX, 1.2, status_color, 3)
+            
+            cv2.putText(display_frame, f"Sensitivity: {detector.threshold_percentage:.1f}%", (10, 80),
+                       cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+            
+            # Encode frame in the background, publish as soon as it's ready
+            pending = encoder.submit(encode_jpeg, display_frame)
+            pending.add_done_callback(lambda f: broadcaster.publish(f.result()))
+    finally:
+        # Always end viewers' streams, even if drawing or detection raised
+        encoder.shutdown(wait=True)
+        broadcaster.close()
 
 
 def generate_live_frames():
-    """Generator for live video streaming"""
-    global live_detector, live_camera, live_active
+    """Generator for live video streaming - sends frames encoded by the processing loop"""
+    broadcaster = live_broadcaster
+    if broadcaster is None:
+        return
     
-    while live_active:
-        if live_camera is None or live_detector is None:
-            break
+    with live_lock:
+        broadcaster.viewers += 1
+    try:
+        seq = 0
+        while live_active:
+            seq, frame_bytes = broadcaster.wait_next(seq)
+            if frame_bytes is None:
+                break
             
-        ret, frame = live_camera.read()
-        if not ret:
-            break
-        
-        display_frame = frame.copy()
-        
-        # Draw door frame
-        if live_detector.door_roi:
-            x, y, w, h = live_detector.door_roi
-            cv2.rectangle(display_frame, (x, y), (x+w, y+h), (0, 255, 255), 2)
-            cv2.putText(display_frame, "DOOR FRAME", (x, y-10),
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 255, 255), 2)
-        
-        # Detect door status
-        status, processed, change_pct = live_detector.detect_door_status(frame)
-        
-        # Log status
-        if status in ["OPEN", "CLOSED"]:
-            live_detector.log_status(status)
-        
-        # Display status
-        status_color = (0, 255, 0) if status == "CLOSED" else (0, 0, 255)
-        cv2.rectangle(display_frame, (5, 5), (300, 60), (0, 0, 0), -1)
-        cv2.putText(display_frame, f"Door: {status}", (10, 40),
-                   cv2.FONT_HERSHEY_SIMPLEX, 1.2, status_color, 3)
-        
-        cv2.putText(display_frame, f"Sensitivity: {live_detector.threshold_percentage:.1f}%", (10, 80),
-                   cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
-        
-        # Encode frame
-        ret, buffer = cv2.imencode('.jpg', display_frame)
-        frame_bytes = buffer.tobytes()
-        
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+            yield (b'--frame\r\n'
+                   b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
+    finally:
+        with live_lock:
+            broadcaster.viewers -= 1
 
 
 def generate_video_playback():
@@ -140,21 +399,26 @@ def generate_video_playback():
     
     frame_count = 0
     
+    # Door status changes over seconds, so detect ~10 times per second and
+    # reuse the last result for the frames in between
+    detect_every = max(1, int(round(fps / 10))) if fps > 0 else 1
+    status, change_pct = "Unknown", 0
+    
     while True:
         ret, frame = cap.read()
         if not ret:
             break
         
-        display_frame = frame.copy()
+        # frame is not reused after this iteration, so overlays are drawn on it directly
+        display_frame = frame
         
-        # Draw door frame
-        if video_detector and video_detector.door_roi:
-            x, y, w, h = video_detector.door_roi
-            cv2.rectangle(display_frame, (x, y), (x+w, y+h), (0, 255, 255), 3)
-        
-        # Detect door status
+        # Detect door status (before anything is drawn on the frame)
         if video_detector:
-            status, _, change_pct = video_detector.detect_door_status(frame)
+            if frame_count % detect_every == 0:
+                status, _, change_pct = video_detector.detect_door_status(frame, build_vis=False)
+            
+            # Draw door frame
+            video_detector.draw_door_frame(display_frame, thickness=3)
             
             # Calculate timestamp
             timestamp = frame_count / fps if fps > 0 else frame_count
@@ -163,11 +427,9 @@ def generate_video_playback():
             # Display status overlay
             status_color = (0, 255, 0) if status == "CLOSED" else (0, 0, 255)
             
-            # Create semi-transparent overlay at top
-            overlay = display_frame.copy()
-            height, width = display_frame.shape[:2]
-            cv2.rectangle(overlay, (0, 0), (width, 100), (0, 0, 0), -1)
-            cv2.addWeighted(overlay, 0.7, display_frame, 0.3, 0, display_frame)
+            # Darken the top strip in place - same as blending 70% black over rows 0-100
+            strip = display_frame[:101]
+            cv2.convertScaleAbs(strip, dst=strip, alpha=0.3)
             
             # Status text - larger and more prominent
             cv2.putText(display_frame, f"Door: {status}", (20, 50),
@@ -180,8 +442,7 @@ def generate_video_playback():
         frame_count += 1
         
         # Encode frame
-        ret, buffer = cv2.imencode('.jpg', display_frame)
-        frame_bytes = buffer.tobytes()
+        frame_bytes = encode_jpeg(display_frame)
         
         yield (b'--frame\r\n'
                b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')
@@ -198,42 +459,74 @@ def index():
 @app.route('/start_live', methods=['POST'])
 def start_live():
     """Start live detection"""
-    global live_detector, live_camera, live_active
+    global live_detector, live_camera, live_active, live_broadcaster, live_thread
     
     with live_lock:
         if live_active:
             return jsonify({'success': False, 'message': 'Already running'})
         
-        live_camera = cv2.VideoCapture(0)
-        if not live_camera.isOpened():
+        cap = cv2.VideoCapture(0)
+        if not cap.isOpened():
             return jsonify({'success': False, 'message': 'Camera not available'})
         
-        live_camera.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-        live_camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+        # Take MJPG straight from the camera - must be set before the resolution,
+        # some backends (DirectShow/MSMF) ignore or reset it otherwise
+        if not cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG')):
+            app.logger.warning("Camera driver refused MJPG fourcc")
+        
+        cap.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
+        cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
+        
+        # Keep only the newest frame
+        if not cap.set(cv2.CAP_PROP_BUFFERSIZE, 1):
+            app.logger.warning("Camera driver refused CAP_PROP_BUFFERSIZE=1")
+        
+        live_camera = CameraReader(cap)
         
         live_detector = SimpleDoorDetector()
+        live_broadcaster = FrameBroadcaster()
         live_active = True
         
+        live_thread = threading.Thread(target=live_processing_loop,
+                                       args=(live_camera, live_detector, live_broadcaster),
+                                       daemon=True)
+        live_thread.start()
+        
         return jsonify({'success': True, 'message': 'Live detection started'})
 
 
 @app.route('/stop_live', methods=['POST'])
 def stop_live():
     """Stop live detection"""
-    global live_detector, live_camera, live_active
+    global live_detector, live_camera, live_active, live_broadcaster, live_thread
     
     with live_lock:
         live_active = False
         if live_camera:
             live_camera.release()
             live_camera = None
+        if live_thread:
+            live_thread.join(timeout=1.0)
+            live_thread = None
+        if live_broadcaster:
+            live_broadcaster.close()
+            live_broadcaster = None
         
-        history = live_detector.history if live_detector else []
+        history = live_detector.get_history() if live_detector else []
         live_detector = None
         
         return jsonify({'success': True, 'history': history})
 
 
+@app.route('/debug_view', methods=['POST'])
+def toggle_debug_view():
+    """Toggle the diff heatmap overlay on the live stream"""
+    global debug_view
+    
+    debug_view = not debug_view
+    return jsonify({'success': True, 'debug': debug_view})
+
+
 @app.route('/video_feed')
 def video_feed():
     """Video streaming route"""